@@ -1,38 +1,114 @@
-import os, time, hashlib, traceback, re, uuid
+import os, sys, time, hashlib, traceback, re, random, threading, atexit, weakref
+from collections import deque
 from contextlib import contextmanager
 from datetime import datetime, timezone
+from functools import lru_cache
+
+try:  # optional: pip install pointer_telemetry[blake3]
+    from blake3 import blake3 as _fp_hash
+except ImportError:
+    _fp_hash = hashlib.sha256
+
+# caps on stored message/template/stack text; fingerprints are computed before truncation
+MAX_MSG = 4096
+MAX_STACK = 16384
 
 NUMBER_RE = re.compile(r"\b\d{3,}\b")  # crude de-noising for message_template
 EMAIL_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
 HEX_RE   = re.compile(r"\b[0-9a-fA-F]{16,}\b")
+# all three in one pass; group names double as the placeholders. Email first so
+# digits/hex inside an address don't win, num before hex so all-digit runs stay <num>
+COMBINED_RE = re.compile(
+    rf"(?P<email>{EMAIL_RE.pattern})|(?P<num>{NUMBER_RE.pattern})|(?P<hex>{HEX_RE.pattern})"
+)
+
+# maps ASCII digits and "@" to b"!", a-f/A-F to b"x", everything else to b" ".
+# <num>/<email> need a "!", and a digit-free <hex> needs 16 consecutive "x", so a
+# translated message with neither cannot match COMBINED_RE
+_PREFILTER_TABLE = bytes(
+    ord("!") if b in b"0123456789@" else ord("x") if b in b"abcdefABCDEF" else ord(" ")
+    for b in range(256)
+)
+_HEX_LETTER_RUN = b"x" * 16
+
+# private PRNG for request ids: no syscall per id, unaffected by app code calling
+# random.seed(), and reseeded in forked children so prefork workers don't collide
+_id_rng = random.Random(os.urandom(16))
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: _id_rng.seed(os.urandom(16)))
 
 def new_request_id() -> str:
-    return uuid.uuid4().hex[:16]
+    return f"{_id_rng.getrandbits(64):016x}"
 
 def message_template(s: str | None) -> str | None:
     if not s:
         return None
-    s = NUMBER_RE.sub("<num>", s)
-    s = EMAIL_RE.sub("<email>", s)
-    s = HEX_RE.sub("<hex>", s)
-    return s
+    # non-ASCII text may hold Unicode digits that \d matches, so only prefilter ASCII
+    if s.isascii():
+        classes = s.encode("ascii").translate(_PREFILTER_TABLE)
+        if b"!" not in classes and _HEX_LETTER_RUN not in classes:
+            return s
+    return COMBINED_RE.sub(_placeholder, s)
+
+def _placeholder(m: re.Match) -> str:
+    return f"<{m.lastgroup}>"
+
+def exception_type_name(exc_class: type) -> str:
+    """Class name as the last line of a traceback shows it, e.g. `requests.exceptions.ConnectionError`."""
+    name = exc_class.__qualname__
+    mod = exc_class.__module__
+    if mod not in ("__main__", "builtins"):
+        name = f"{mod if isinstance(mod, str) else '<unknown>'}.{name}"
+    return name
+
+def fingerprint_tail(service: str, release: str | None) -> bytes:
+    """Encoded `|service|release` suffix of the fingerprint key; constant per handler/logger."""
+    return f"|{service or ''}|{release or ''}".encode("utf-8")
 
 def error_fingerprint(exc_type: str, msg_template: str | None, top_frames: list[str], service: str, release: str | None) -> str:
-    key = "|".join([
-        exc_type or "",
-        msg_template or "",
-        ";".join(top_frames[:5]),
-        service or "",
-        release or ""
-    ])
-    return hashlib.sha1(key.encode("utf-8")).hexdigest()
-
-def stack_top_frames(tb_text: str | None) -> list[str]:
+    return error_fingerprint_with_tail(exc_type, msg_template, tuple(top_frames[:5]), fingerprint_tail(service, release))
+
+def error_fingerprint_with_tail(exc_type: str, msg_template: str | None, top_frames: tuple[str, ...], tail: bytes) -> str:
+    # oversized templates (unmasked payloads) would each pin a huge cache key; hash them directly
+    if msg_template and len(msg_template) > MAX_MSG:
+        return _error_fingerprint(exc_type, msg_template, top_frames, tail)
+    return _cached_error_fingerprint(exc_type, msg_template, top_frames, tail)
+
+def _error_fingerprint(exc_type: str, msg_template: str | None, top_frames: tuple[str, ...], tail: bytes) -> str:
+    return error_fingerprint_bytes(
+        (exc_type or "").encode("utf-8"),
+        (msg_template or "").encode("utf-8"),
+        ";".join(top_frames[:5]).encode("utf-8"),
+        tail,
+    )
+
+# identical errors recur constantly; key the cache on a hashable tuple of the frames used
+_cached_error_fingerprint = lru_cache(maxsize=4096)(_error_fingerprint)
+
+def error_fingerprint_bytes(exc_type_b: bytes, msg_t_b: bytes, frames_joined_b: bytes, tail_b: bytes) -> str:
+    # feeds the same `exc|template|frames|service|release` key as before, without joining it
+    h = _fp_hash()
+    h.update(exc_type_b)
+    h.update(b"|")
+    h.update(msg_t_b)
+    h.update(b"|")
+    h.update(frames_joined_b)
+    h.update(tail_b)
+    # digest is only a group key; truncate to fit the 40-char fingerprint column
+    return h.hexdigest()[:40]
+
+def stack_top_frames(tb_text: str | None, limit: int = 5) -> list[str]:
     if not tb_text:
         return []
-    lines = [ln.strip() for ln in tb_text.splitlines() if ln.strip()]
-    # Keep only "File ..., line ..., in ..." lines for stability
-    frames = [ln for ln in lines if ln.startswith('File "')]
+    # Keep only "File ..., line ..., in ..." lines for stability; error_fingerprint
+    # only uses the first few, so stop scanning once we have them
+    frames = []
+    for ln in tb_text.splitlines():
+        ln = ln.strip()
+        if ln.startswith('File "'):
+            frames.append(ln)
+            if len(frames) >= limit:
+                break
     return frames
 
 @contextmanager
@@ -42,12 +118,15 @@ def track_latency(db, *, service: str, peer: str, route: str, method: str,
                   slow_ms: int = 2000,
                   sample_rate_fast: float = 0.02,
                   write_http_row=None,
-                  log_warning=None):
+                  log_warning=None,
+                  include_created_at: bool = False):
     """
     Times a block. Records slow calls as WARNING into ErrorLog, and optionally
     writes a row into http_calls (full-fidelity metrics) if write_http_row is provided.
+    Rows carry no created_at (the column default fills in insert time) unless
+    include_created_at=True, which stamps the call's completion time in Python.
     """
-    t0 = time.time()
+    t0 = time.perf_counter_ns()
     req_id = request_id or new_request_id()
     try:
         yield {"request_id": req_id}
@@ -58,19 +137,23 @@ def track_latency(db, *, service: str, peer: str, route: str, method: str,
         status = 500
         raise
     finally:
-        ms = int((time.time() - t0) * 1000)
-        # 1) optional metrics row
+        ms = (time.perf_counter_ns() - t0) // 1_000_000
+        slow = ms >= slow_ms
+        # 1) optional metrics row; the dict is only built for kept samples
         if write_http_row:
             # sampling for fast calls
-            if (not ok) or (ms >= slow_ms) or (os.urandom(1)[0] / 255.0 < sample_rate_fast):
-                write_http_row(dict(
-                    created_at=datetime.now(timezone.utc),
+            if (not ok) or slow or (random.random() < sample_rate_fast):
+                # created_at is left to the http_calls column's default unless asked for
+                row = dict(
                     service=service, peer=peer, route=route, method=method,
                     status=status, ok=ok, latency_ms=ms, request_id=req_id,
                     clinic_id=clinic_id, dog_id=dog_id
-                ))
-        # 2) slow warning to ErrorLog
-        if (ms >= slow_ms) and log_warning:
+                )
+                if include_created_at:
+                    row["created_at"] = datetime.now(timezone.utc)
+                write_http_row(row)
+        # 2) slow warning to ErrorLog; message strings are only formatted here
+        if slow and log_warning:
             log_warning(
                 message=f"SLOW {peer} {method} {route} {ms}ms",
                 level="WARNING",
@@ -78,3 +161,139 @@ def track_latency(db, *, service: str, peer: str, route: str, method: str,
                 http_method=method, http_status=status, latency_ms=ms,
                 clinic_id=clinic_id, dog_id=dog_id
             )
+
+# (max_batch, max_age_ms) per metrics store: row stores like Postgres/Timescale want
+# moderate batches, ClickHouse prefers few large inserts
+HTTP_WRITER_DEFAULTS = {
+    "timescale": (500, 1000),
+    "postgres": (500, 1000),
+    "clickhouse": (5000, 2000),
+}
+
+class BatchedHttpWriter:
+    """
+    Drop-in `write_http_row` for track_latency that buffers rows and hands them to
+    `real_writer(rows: list[dict])` from a daemon thread, once `max_batch` rows are
+    waiting or the oldest is `max_age_ms` old. The buffer is a ring of `queue_size`
+    rows: under sustained overload the oldest rows are dropped, callers never block.
+
+    real_writer runs off the request thread, so it must open its own connection
+    (e.g. `with engine.begin() as conn`) rather than use a Flask-scoped db.session.
+    Open writers are flushed at interpreter exit and get a fresh buffer and thread in
+    forked children (e.g. gunicorn --preload).
+    """
+    def __init__(self, real_writer, *, max_batch: int, max_age_ms: int, queue_size: int = 10_000):
+        self.real_writer = real_writer
+        self.max_batch = max_batch
+        self.max_age = max_age_ms / 1000.0
+        self.queue_size = queue_size
+        self._closed = False
+        self._start()
+        _http_writers.add(self)
+
+    def _start(self):
+        # rows buffered before a fork belong to the parent's thread; the child starts empty
+        self._buf = deque(maxlen=self.queue_size)
+        self._cond = threading.Condition()
+        self._first_at = 0.0
+        # rows ever appended / handed to real_writer or dropped by the ring; flush() waits
+        # for _handled to reach the _appended value it saw, not for an empty buffer
+        self._appended = 0
+        self._handled = 0
+        self._flush_waiters = 0
+        self._thread = threading.Thread(target=self._run, name="BatchedHttpWriter", daemon=True)
+        self._thread.start()
+
+    def __call__(self, row: dict):
+        with self._cond:
+            if not self._buf:
+                self._first_at = time.monotonic()
+                self._cond.notify()
+            elif len(self._buf) == self.queue_size:
+                self._handled += 1  # append() is about to drop the oldest row
+            self._buf.append(row)
+            self._appended += 1
+            if len(self._buf) >= self.max_batch:
+                self._cond.notify()
+
+    def _run(self):
+        cond, buf = self._cond, self._buf
+        while True:
+            with cond:
+                while not buf and not self._closed:
+                    cond.wait()
+                if not buf:
+                    return
+                deadline = self._first_at + self.max_age
+                while len(buf) < self.max_batch and not (self._flush_waiters or self._closed):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    cond.wait(remaining)
+                batch = [buf.popleft() for _ in range(min(len(buf), self.max_batch))]
+            try:
+                self.real_writer(batch)
+            except Exception as err:
+                print(f"[BatchedHttpWriter] failed to write {len(batch)} http_calls rows: {err}", file=sys.stderr)
+            finally:
+                with cond:
+                    self._handled += len(batch)
+                    cond.notify_all()
+
+    def flush(self, timeout: float = 5.0):
+        """
+        Wait (at most `timeout` seconds) until every row buffered before this call has
+        been handed to real_writer. Rows added concurrently are not waited for.
+        """
+        with self._cond:
+            if not self._thread.is_alive():
+                return
+            target = self._appended
+            self._flush_waiters += 1
+            self._cond.notify_all()
+            try:
+                self._cond.wait_for(lambda: self._handled >= target, timeout)
+            finally:
+                self._flush_waiters -= 1
+
+    def close(self):
+        """Write whatever is buffered and stop the background thread."""
+        _http_writers.discard(self)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=5)
+
+# one exit/fork hook for all open writers; the WeakSet doesn't keep closed ones alive
+_http_writers = weakref.WeakSet()
+
+@atexit.register
+def _close_http_writers():
+    for writer in list(_http_writers):
+        writer.close()
+
+def _restart_http_writers_in_child():
+    for writer in list(_http_writers):
+        writer._start()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_http_writers_in_child)
+
+def make_batched_http_writer(real_writer, *, backend: str = "timescale",
+                             max_batch: int | None = None, max_age_ms: int | None = None,
+                             queue_size: int = 10_000) -> BatchedHttpWriter:
+    """
+    Wraps `real_writer(rows)` in a BatchedHttpWriter using the `backend` defaults from
+    HTTP_WRITER_DEFAULTS; explicit max_batch/max_age_ms override them.
+    Usage:
+        write_http_row = make_batched_http_writer(insert_http_rows, backend="clickhouse")
+        with track_latency(..., write_http_row=write_http_row): ...
+        write_http_row.flush()  # e.g. at the end of a script
+    """
+    default_batch, default_age_ms = HTTP_WRITER_DEFAULTS[backend]
+    return BatchedHttpWriter(
+        real_writer,
+        max_batch=max_batch or default_batch,
+        max_age_ms=max_age_ms or default_age_ms,
+        queue_size=queue_size,
+    )
@@ -1,24 +1,132 @@
 # pointer_telemetry/db_log_handler.py
-import logging, traceback, sys
+import logging, os, sys, queue, threading, time, weakref
+from functools import lru_cache
 from flask import has_request_context, request, has_app_context
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import insert, create_engine
 from datetime import datetime, timezone
 from .errorlog import make_error_logger
-from .context import message_template, stack_top_frames, error_fingerprint
+from .context import message_template, stack_top_frames, error_fingerprint_with_tail, fingerprint_tail, exception_type_name, MAX_MSG, MAX_STACK
+
+_formatter = logging.Formatter()
+
+
+# records come from a small set of call sites, so these strings repeat constantly
+@lru_cache(maxsize=1024)
+def _compose_function_name(mod, func_name):
+    return f"{mod}.{func_name}" if mod else func_name
+
+@lru_cache(maxsize=1024)
+def _path_basename(pathname):
+    return pathname.rsplit("/", 1)[-1]
+
+# queue markers understood by _Worker
+_STOP = object()
+
+class _FlushRequest:
+    # set by the worker once every row queued before this marker has been written
+    __slots__ = ("done",)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+# live handlers; forked children (e.g. gunicorn --preload) inherit the queue but not
+# the writer thread, so each open handler gets a fresh queue and worker in the child
+_handlers = weakref.WeakSet()
+
+def _restart_workers_in_child():
+    for handler in list(_handlers):
+        if handler._owned_engine is not None:
+            # drop the parent's pooled connections without closing its sockets
+            handler._owned_engine.dispose(close=False)
+        handler._start_worker()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_workers_in_child)
+
+
+class _Worker(threading.Thread):
+    """
+    Drains the handler's queue and writes rows in batches of up to `max_batch`,
+    or whatever has arrived once the oldest pending row is `max_age_ms` old.
+    """
+    def __init__(self, handler, *, max_batch, max_age_ms):
+        super().__init__(name="DBLogHandler-writer", daemon=True)
+        self.handler = handler
+        self.max_batch = max_batch
+        self.max_age = max_age_ms / 1000.0
+
+    def run(self):
+        q = self.handler._queue
+        while True:
+            item = q.get()
+            batch = []
+            deadline = time.monotonic() + self.max_age
+            while item is not _STOP and not isinstance(item, _FlushRequest):
+                batch.append(item)
+                if len(batch) >= self.max_batch:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = q.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if batch:
+                self.handler._write_batch(batch)
+            if isinstance(item, _FlushRequest):
+                item.done.set()
+            elif item is _STOP:
+                return
 
 
 class DBLogHandler(logging.Handler):
+    """
+    Logging handler that writes WARNING/ERROR records to ErrorLogModel.
+
+    emit() only builds the row and queues it; a daemon thread bulk-inserts
+    queued rows so the logging caller never waits on the database. When the
+    queue is full, records are dropped (with a note on stderr) rather than
+    blocking. Call flush() to wait for queued rows, close() on shutdown
+    (logging.shutdown() does both at interpreter exit).
+
+    With own_pool=True the handler writes through a small LIFO pool of its own,
+    built from engine.url, so telemetry never competes with the app's pool.
+    """
     def __init__(self, *, engine, ErrorLogModel, service, environment,
-                 release_version=None, build_sha=None, level=logging.INFO):
+                 release_version=None, build_sha=None, level=logging.INFO,
+                 max_batch=500, max_age_ms=1000, queue_size=10_000,
+                 own_pool=False):
         super().__init__(level=level)
-        # independent sessionmaker avoids touching Flask's db.session
-        self.Session = sessionmaker(bind=engine, expire_on_commit=False, future=True)
+        self._owned_engine = None
+        if own_pool:
+            # LIFO keeps reusing the same hot connection and lets idle ones time out
+            engine = self._owned_engine = create_engine(
+                engine.url, pool_use_lifo=True, pool_pre_ping=True,
+                pool_size=2, max_overflow=2, pool_recycle=1800,
+            )
+        # plain connections from our own engine; never touches Flask's db.session
+        self._engine = engine
         self.ErrorLogModel = ErrorLogModel
+        # Core INSERT: rows are write-only, so skip ORM instances/identity map
+        self._insert_stmt = insert(ErrorLogModel)
         self.service = service
         self.environment = environment
         self.release_version = release_version
         self.build_sha = build_sha
-    
+        self._fp_tail = fingerprint_tail(service, release_version)
+        self._max_batch = max_batch
+        self._max_age_ms = max_age_ms
+        self._queue_size = queue_size
+        self._start_worker()
+        _handlers.add(self)
+
+    def _start_worker(self):
+        # rows queued before a fork belong to the parent's worker; the child starts empty
+        self._queue = queue.Queue(maxsize=self._queue_size)
+        self._worker = _Worker(self, max_batch=self._max_batch, max_age_ms=self._max_age_ms)
+        self._worker.start()
+
     def emit(self, record: logging.LogRecord):
         # fast reject below threshold (also set via setLevel)
         if record.levelno < logging.WARNING:
@@ -26,32 +134,41 @@ class DBLogHandler(logging.Handler):
         try:
             # Use getMessage() to avoid re-formatting exceptions twice
             msg = record.getMessage()
-            stack = "".join(traceback.format_exception(*record.exc_info)) if record.exc_info else None
+            # reuse the traceback text if another handler's Formatter already cached it;
+            # don't cache ours on the record, later handlers may format it their own way
+            stack = record.exc_text
+            if not stack and record.exc_info:
+                stack = _formatter.formatException(record.exc_info)
 
             route = function_name = http_method = None
-            http_status      = getattr(record, "http_status", None)
-            session_id       = getattr(record, "session_id", None)
-            host             = getattr(record, "host", None)
-            service_component= getattr(record, "service_component", None)
-            message_params   = getattr(record, "message_params", None)
-            request_id = getattr(record, "request_id", None)
-            clinic_id     = getattr(record, "clinic_id", None)
-            dog_id     = getattr(record, "dog_id", None)
-            latency_ms = getattr(record, "latency_ms", None)
-            tags       = getattr(record, "tags", None)
+            # `extra=` fields live in the instance dict; plain dict probes skip getattr machinery
+            rd = record.__dict__
+            http_status      = rd.get("http_status")
+            session_id       = rd.get("session_id")
+            host             = rd.get("host")
+            service_component= rd.get("service_component")
+            message_params   = rd.get("message_params")
+            request_id = rd.get("request_id")
+            clinic_id     = rd.get("clinic_id")
+            dog_id     = rd.get("dog_id")
+            latency_ms = rd.get("latency_ms")
+            tags       = rd.get("tags")
 
             if has_request_context():
                 try:
-                    http_method = request.method
-                    route = request.url_rule.rule if request.url_rule else request.path
-                    function_name = request.endpoint
-                    request_id = request.headers.get("X-Request-ID", request_id)
+                    # resolve the LocalProxy once instead of on every attribute access
+                    req = request._get_current_object()
+                    http_method = req.method
+                    url_rule = req.url_rule
+                    route = url_rule.rule if url_rule else req.path
+                    function_name = req.endpoint
+                    request_id = req.headers.get("X-Request-ID", request_id)
                 except Exception:
                     pass
 
             if not function_name and record.funcName:
-                mod = record.module or (record.pathname.rsplit("/",1)[-1] if record.pathname else None)
-                function_name = f"{mod}.{record.funcName}" if mod else record.funcName
+                mod = record.module or (_path_basename(record.pathname) if record.pathname else None)
+                function_name = _compose_function_name(mod, record.funcName)
 
             level = record.levelname.upper()
             if level not in ("ERROR", "WARNING"):
@@ -59,58 +176,82 @@ class DBLogHandler(logging.Handler):
                 
             msg_t = message_template(msg)
             frames = stack_top_frames(stack)
-            exc_type = None
-            if stack and "Traceback" in stack:
-                # best-effort, you can pass exc_type explicitly if you want
-                try:
-                    exc_type = stack.strip().splitlines()[-1].split(":")[0].strip()
-                except Exception:
-                    exc_type = None
+            exc_type = exception_type_name(record.exc_info[0]) if record.exc_info and record.exc_info[0] else None
 
-            fp = error_fingerprint(
+            fp = error_fingerprint_with_tail(
                 exc_type or (function_name or "UnknownError"),
                 msg_t,
-                frames,
-                self.service,
-                self.release_version or ""
+                tuple(frames),
+                self._fp_tail,
             )
                 
-            session = self.Session()
+            row = dict(
+                level=level,
+                message=msg[:MAX_MSG],
+                message_template=msg_t[:MAX_MSG] if msg_t else None,
+                stack_trace=stack[:MAX_STACK] if stack else None,
+                route=route,
+                function_name=function_name,
+                http_method=http_method,
+                http_status=http_status,
+                latency_ms=latency_ms,
+                clinic_id=clinic_id,
+                dog_id=dog_id,
+                request_id=request_id,
+                session_id=session_id,
+                host=host,
+                service_component=service_component,
+                message_params=message_params,
+                service=self.service,
+                environment=self.environment,
+                release_version=self.release_version,
+                build_sha=self.build_sha,
+                tags=tags,
+                fingerprint=fp,
+            )
             try:
-                row = self.ErrorLogModel(
-                    level=level,
-                    message=msg[:10000],
-                    message_template=msg_t,
-                    stack_trace=stack,
-                    route=route,
-                    function_name=function_name,
-                    http_method=http_method,
-                    http_status=http_status,
-                    latency_ms=latency_ms,
-                    clinic_id=clinic_id,
-                    dog_id=dog_id,
-                    request_id=request_id,
-                    session_id=session_id,
-                    host=host,
-                    service_component=service_component,
-                    message_params=message_params,
-                    service=self.service,
-                    environment=self.environment,
-                    release_version=self.release_version,
-                    build_sha=self.build_sha,
-                    tags=tags,
-                    fingerprint=fp,
-                )
-                session.add(row)
-                session.commit()
-            except Exception as err:
-                try:
-                    session.rollback()
-                except Exception:
-                    pass
-                print(f"[DBLogHandler] failed to write ErrorLog: {err}", file=sys.stderr)
-            finally:
-                session.close()  # fully independent; no app context to pop
+                self._queue.put_nowait(row)
+            except queue.Full:
+                # never block the logging caller
+                print("[DBLogHandler] queue full, dropping ErrorLog row", file=sys.stderr)
         except Exception as outer:
             # never re-log inside a handler; just print to stderr
             print(f"[DBLogHandler] emit crash: {outer}", file=sys.stderr)
+
+    def _write_batch(self, rows):
+        # one bulk INSERT + commit for the whole batch; runs on the worker thread.
+        # begin() commits on success and rolls back if the INSERT raises
+        try:
+            with self._engine.begin() as conn:
+                conn.execute(self._insert_stmt, rows)
+        except Exception as err:
+            print(f"[DBLogHandler] failed to write {len(rows)} ErrorLog rows: {err}", file=sys.stderr)
+
+    def flush(self, timeout=5.0):
+        """
+        Wait (at most `timeout` seconds) until every row queued before this call has
+        been written. Rows logged concurrently are not waited for. The bound matters at
+        exit: logging.shutdown() calls flush() holding the handler lock, and a record
+        logged by the worker itself (e.g. from the DB driver) would otherwise deadlock.
+        """
+        if not self._worker.is_alive():
+            return
+        req = _FlushRequest()
+        try:
+            self._queue.put(req, timeout=timeout)
+        except queue.Full:
+            return
+        req.done.wait(timeout)
+
+    def close(self):
+        """Write whatever is queued, stop the worker thread and close the handler."""
+        _handlers.discard(self)
+        if self._worker.is_alive():
+            try:
+                self._queue.put(_STOP, timeout=5)
+            except queue.Full:
+                pass
+            self._worker.join(timeout=5)
+        if self._owned_engine is not None:
+            self._owned_engine.dispose()
+        super().close()
@@ -1,14 +1,26 @@
 import os, traceback
-from .context import message_template, error_fingerprint, stack_top_frames
+from sqlalchemy import insert
+from .context import message_template, error_fingerprint_with_tail, fingerprint_tail, exception_type_name, stack_top_frames, MAX_MSG, MAX_STACK
 
-def make_error_logger(db_session, ErrorLogModel, *, service: str, environment: str, release_version: str | None=None, build_sha: str | None=None):
+class ErrorLogger:
     """
-    Returns a function `log_error(**kwargs)` that writes to ErrorLog safely.
-    Usage:
-        log_error = make_error_logger(db.session, ErrorLog, service="processing", environment="prod", release_version=GIT_TAG)
-        log_error(message=str(e), stack_trace=tb, route="/process_patient", function_name="process_patient_task", clinic_id=..., clinic_id=..., dog_id=...)
+    Callable that writes to ErrorLog safely; see make_error_logger.
+    `db_session` is a plain attribute, so one instance can be pointed at another session scope;
+    service/release_version are baked into the fingerprint tail at construction.
     """
-    def _log_error(
+    __slots__ = ("db_session", "ErrorLogModel", "service", "environment", "release_version", "build_sha", "_fp_tail")
+
+    def __init__(self, db_session, ErrorLogModel, *, service: str, environment: str, release_version: str | None=None, build_sha: str | None=None):
+        self.db_session = db_session
+        self.ErrorLogModel = ErrorLogModel
+        self.service = service
+        self.environment = environment
+        self.release_version = release_version
+        self.build_sha = build_sha
+        self._fp_tail = fingerprint_tail(service, release_version)
+
+    def __call__(
+        self,
         *,
         message: str,
         level: str = "ERROR",
@@ -24,36 +36,37 @@ def make_error_logger(db_session, ErrorLogModel, *, service: str, environment: s
         request_id: str | None = None,
         session_id: str | None = None,
         service_component: str | None = None,
+        exc_type: type | str | None = None,
     ):
         msg_t = message_template(message)
         frames = stack_top_frames(stack_trace)
-        exc_type = None
-        if stack_trace and "Traceback" in stack_trace:
+        if isinstance(exc_type, type):
+            exc_type = exception_type_name(exc_type)
+        elif not exc_type and stack_trace and "Traceback" in stack_trace:
             # best-effort, you can pass exc_type explicitly if you want
             try:
                 exc_type = stack_trace.strip().splitlines()[-1].split(":")[0].strip()
             except Exception:
                 exc_type = None
 
-        fp = error_fingerprint(
+        fp = error_fingerprint_with_tail(
             exc_type or (function_name or "UnknownError"),
             msg_t,
-            frames,
-            service,
-            release_version or ""
+            tuple(frames),
+            self._fp_tail,
         )
 
-        row = ErrorLogModel(
+        row = dict(
             level=level,
-            message=message[:10000],
-            message_template=msg_t,
+            message=message[:MAX_MSG],
+            message_template=msg_t[:MAX_MSG] if msg_t else None,
             message_params=message_params,
-            stack_trace=stack_trace,
-            environment=environment,
-            service=service,
+            stack_trace=stack_trace[:MAX_STACK] if stack_trace else None,
+            environment=self.environment,
+            service=self.service,
             service_component=service_component,
-            release_version=release_version,
-            build_sha=build_sha,
+            release_version=self.release_version,
+            build_sha=self.build_sha,
             route=route,
             http_method=http_method,
             http_status=http_status,
@@ -66,9 +79,21 @@ def make_error_logger(db_session, ErrorLogModel, *, service: str, environment: s
             tags=tags or {},
         )
         try:
-            db_session.add(row)
-            db_session.commit()
+            self.db_session.execute(insert(self.ErrorLogModel).values(**row))
+            self.db_session.commit()
         except Exception:
             # never blow up the caller
-            db_session.rollback()
-    return _log_error
+            self.db_session.rollback()
+
+
+def make_error_logger(db_session, ErrorLogModel, *, service: str, environment: str, release_version: str | None=None, build_sha: str | None=None):
+    """
+    Returns a callable `log_error(**kwargs)` (an ErrorLogger) that writes to ErrorLog safely.
+    Usage:
+        log_error = make_error_logger(db.session, ErrorLog, service="processing", environment="prod", release_version=GIT_TAG)
+        log_error(message=str(e), stack_trace=tb, route="/process_patient", function_name="process_patient_task", clinic_id=..., clinic_id=..., dog_id=...)
+    Pass `exc_type=type(e)` to skip parsing it out of the last line of `stack_trace`
+    (it is rendered module-qualified, the same way the traceback shows it).
+    """
+    return ErrorLogger(db_session, ErrorLogModel, service=service, environment=environment,
+                       release_version=release_version, build_sha=build_sha)
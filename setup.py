@@ -8,5 +8,8 @@ setup(
         "Flask>=3.0,<4",
         "Flask-SQLAlchemy>=3.1,<4",
         "SQLAlchemy>=2.0,<3"
-    ]
+    ],
+    extras_require={
+        "blake3": ["blake3>=0.3"],
+    }
 )